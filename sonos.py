@@ -1,20 +1,16 @@
 #!/usr/bin/env python3
 
+import os
 import sys
+import json
+import time
 import logging
-#import soco
-from ipaddress import *
-from difflib import SequenceMatcher
-from requests.exceptions import ConnectTimeout
+import threading
+from queue import Empty
+from requests.exceptions import ConnectTimeout, RequestException
 from urllib3.exceptions import TimeoutError
 from ast import literal_eval
 
-from soco import SoCo
-from soco.groups import ZoneGroup
-from soco.discovery import by_name as SoCo_ByName
-from soco.music_library import MusicLibrary
-from soco.exceptions import SoCoException
-from soco.data_structures import *
 from kalliope.core.NeuronModule import NeuronModule, MissingParameterException, InvalidParameterException
 from kalliope.core.NeuronExceptions import NeuronExceptions
 from kalliope.core.Utils.Utils import Utils
@@ -23,6 +19,8 @@ from kalliope.core.ConfigurationManager import SettingEditor
 logging.basicConfig()
 logger = logging.getLogger("kalliope")
 
+_CACHE = os.path.expanduser('~/.cache/kalliope_sonos.json')
+
 
 class SonosException(NeuronExceptions):
     def __init__(self, message, **kwargs):
@@ -32,19 +30,21 @@ class SonosException(NeuronExceptions):
 
 class Sonos(NeuronModule):
 
+    _ACTION_METHOD = {"init": "do_init",
+                      "play": "do_play",
+                      "pause": "do_pause",
+                      "stop": "do_pause",
+                      "next": "do_next",
+                      "previous": "do_prev",
+                      "mute": "do_mute",
+                      "unmute": "do_unmute",
+                      "sync": "do_sync"}
+    _VALID_ACTIONS = frozenset(_ACTION_METHOD)
+    _RAPIDFUZZ = None # (process, fuzz) if available, False if not, None if not yet resolved
+
     def __init__(self, **kwargs):
         NeuronModule.__init__(self, **kwargs)
         self.action = kwargs.get('action', None)
-        self.actions = {}
-        self.actions["init"] = self.do_init
-        self.actions["play"] = self.do_play
-        self.actions["pause"] = self.do_pause
-        self.actions["stop"] = self.do_pause
-        self.actions["next"] = self.do_next
-        self.actions["previous"] = self.do_prev
-        self.actions["mute"] = self.do_mute
-        self.actions["unmute"] = self.do_unmute
-        self.actions["sync"] = self.do_sync
 
         klass = self.__class__
         if not hasattr(klass, 'config'):
@@ -53,12 +53,14 @@ class Sonos(NeuronModule):
             klass.sonos = dict()
         if not hasattr(klass, 'soco'):
             klass.soco = None
+        if not hasattr(klass, 'subscription'):
+            klass.subscription = None
 
         # check if parameters have been provided
         if self._is_parameters_ok(**kwargs):
             if kwargs.get('room', None) == "":
                 del kwargs['room']
-            self.actions[self.action](**kwargs)
+            getattr(self, Sonos._ACTION_METHOD[self.action])(**kwargs)
         else:
             raise SonosException("Could not execute action='%s', SONOS probably offline" % self.action)
 
@@ -71,7 +73,7 @@ class Sonos(NeuronModule):
         """
         if self.action is None:
             raise MissingParameterException("You must specify a value for 'action'")
-        if self.action not in self.actions:
+        if self.action not in Sonos._VALID_ACTIONS:
             raise InvalidParameterException("The configured value for 'action'(='%s') is not a valid action" % self.action)
         ipv4 = kwargs.get('ipv4', None)
         room = kwargs.get('room', None)
@@ -79,6 +81,7 @@ class Sonos(NeuronModule):
             if room is None:
                 raise InvalidParameterException("You must specify a valid sonos zone name for 'room' in init action")
             if ipv4 is not None:
+                from ipaddress import IPv4Address
                 try:
                     if IPv4Address(ipv4).is_global:
                         raise InvalidParameterException("You must specify a private range IP address for 'ipv4' in init action")
@@ -92,14 +95,36 @@ class Sonos(NeuronModule):
         return True
 
 
+    def _resolve(self, kwargs):
+        """
+        Resolve the (optional) 'room' parameter to the coordinating SoCo instance of that room
+        :return: the SoCo instance for the room, raise an exception otherwise
+
+        .. raises:: InvalidParameterException
+        """
+        klass = self.__class__
+        room = kwargs.get('room', klass.config['room'])
+        soco = klass.sonos['coordinators'].get(room, None)
+        if soco is None:
+            raise InvalidParameterException("The value '%s' is invalid for parameter 'room' in action '%s'" % (room, self.action))
+        return soco
+
+
     def do_init(self, **kwargs):
+        from soco import SoCo
+        from soco.discovery import by_name as SoCo_ByName
+        from soco.exceptions import SoCoException
         klass = self.__class__
         ipv4 = kwargs.get('ipv4', None)
         room = kwargs.get('room', None)
         logger.debug("[sonos] instantiating SoCo (ipv4='%s',room='%s')" % (ipv4, room))
         if ipv4 is None:
-            logger.debug("[sonos] instantiating SoCo using discovery")
-            klass.soco = SoCo_ByName(room)
+            klass.soco = Sonos._load_cached_soco(room)
+            if klass.soco is None:
+                logger.debug("[sonos] instantiating SoCo using discovery")
+                klass.soco = SoCo_ByName(room)
+                if klass.soco is not None:
+                    Sonos._store_cached_soco(room, klass.soco)
         else:
             logger.debug("[sonos] instantiating SoCo using IP address")
             try:
@@ -123,41 +148,48 @@ class Sonos(NeuronModule):
                 klass.config['rooms'][name] = [members]
             else:
                 Utils.print_warning("[sonos] expected config setting 'rooms' to be a list (of rooms) or string (single room), got instance of '%s' for room '%s'" % ( type(members), name))
+        klass.sonos['favorites_dirty'] = True
+        klass.sonos['favorites_update_id'] = None # forces the favorites fetch in do_sync
         self.do_sync()
         if klass.config['room'] not in klass.sonos['rooms']:
             raise InvalidParameterException("You must specify a valid sonos name for 'room' in action '%s'" % self.action)
+        klass._subscribe_favorites()
 
 
     def do_play(self, **kwargs):
+        from soco.exceptions import SoCoException
         klass = self.__class__
         item = kwargs.get('item', None)
         room = kwargs.get('room', klass.config['room'])
-        if room not in klass.sonos['rooms']:
-            raise InvalidParameterException("The value '%s' is invalid for parameter 'room' in action '%s'" % (room, self.action))
-
+        soco = self._resolve(kwargs) # first entry in room is assumed target
         logger.debug("[sonos] configuring room '%s' in SONOS" % (room))
-        soco = klass.sonos['rooms'][room][0] # first entry in list is assumed target
         logger.debug("[sonos] using SoCo(%s) as coordinator for room '%s'" % (soco.ip_address, room))
-        soco.unjoin()
-        for player in klass.sonos['rooms'][room][1:]:
-            try:
-                if player.group.coordinator != player:
-                    logger.debug("[sonos] unjoining SoCo(%s) from '%s'" % (player.ip_address, player.group.label))
-                    player.unjoin()
-                logger.debug("[sonos] joining SoCo(%s) to room '%s'" % (player.ip_address, room))
-                player.join(soco)
-            except (ConnectTimeout, TimeoutError, SoCoException) as e:
-                Utils.print_warning("Failure while trying to communicate with SONOS (%s)" % e.__class__.__name__)
+        members = klass.sonos['rooms'][room]
+        topology = tuple(player.ip_address for player in members)
+        if klass.sonos.get('topology', dict()).get(room, None) == topology and Sonos._is_grouped(soco, topology):
+            logger.debug("[sonos] room '%s' is already grouped in SONOS, not regrouping" % (room))
+        else:
+            grouped = True
+            soco.unjoin()
+            for player in members[1:]:
+                try:
+                    if player.group.coordinator != player:
+                        logger.debug("[sonos] unjoining SoCo(%s) from '%s'" % (player.ip_address, player.group.label))
+                        player.unjoin()
+                    logger.debug("[sonos] joining SoCo(%s) to room '%s'" % (player.ip_address, room))
+                    player.join(soco)
+                except (ConnectTimeout, TimeoutError, SoCoException) as e:
+                    grouped = False
+                    Utils.print_warning("Failure while trying to communicate with SONOS (%s)" % e.__class__.__name__)
+            klass.sonos['topology'] = {room: topology} if grouped else dict()
         if item is not None:
-            results = dict()
-            for favorite in klass.sonos['favorites']:
-                ratio = SequenceMatcher(None, item, favorite).ratio()
-                results[ratio] = favorite
-            result = sorted(results.keys(), reverse=True)[0] # get highest score
-            result = results[result] # get best match
-            logger.debug("[sonos] playing '%s' from favorites in room '%s'" % (result, room))
+            titles, titles_lc, favorites = klass.sonos['favorites'] # read snapshot once, may be replaced by event thread
+            if len(titles) == 0:
+                raise SonosException("Could not play '%s' in room '%s', no favorites available in SONOS" % (item, room))
+            index = Sonos._match_favorite(item.lower(), titles_lc)
+            logger.debug("[sonos] playing '%s' from favorites in room '%s'" % (titles[index], room))
             soco.clear_queue()
-            soco.add_to_queue(klass.sonos['favorites'][result])
+            soco.add_to_queue(favorites[index])
             soco.play_from_queue(0)
         else:
             logger.debug("[sonos] playing queue in room '%s'" % (result, room))
@@ -165,54 +197,42 @@ class Sonos(NeuronModule):
 
 
     def do_pause(self, **kwargs):
-        klass = self.__class__
-        room = kwargs.get('room', klass.config['room'])
-        if room not in klass.sonos['rooms']:
-            raise InvalidParameterException("The value '%s' is invalid for parameter 'room' in action '%s'" % (room, self.action))
-        soco = klass.sonos['rooms'][room][0]
+        soco = self._resolve(kwargs)
         soco.pause()
 
 
     def do_next(self, **kwargs):
-        klass = self.__class__
-        room = kwargs.get('room', klass.config['room'])
-        if room not in klass.sonos['rooms']:
-            raise InvalidParameterException("The value '%s' is invalid for parameter 'room' in action '%s'" % (room, self.action))
-        soco = klass.sonos['rooms'][room][0]
+        soco = self._resolve(kwargs)
         soco.next()
 
 
     def do_prev(self, **kwargs):
-        klass = self.__class__
-        room = kwargs.get('room', klass.config['room'])
-        if room not in klass.sonos['rooms']:
-            raise InvalidParameterException("The value '%s' is invalid for parameter 'room' in action '%s'" % (room, self.action))
-        soco = klass.sonos['rooms'][room][0]
+        soco = self._resolve(kwargs)
         soco.previous()
 
 
     def do_mute(self, **kwargs):
-        klass = self.__class__
-        room = kwargs.get('room', klass.config['room'])
-        if room not in klass.sonos['rooms']:
-            raise InvalidParameterException("The value '%s' is invalid for parameter 'room' in action '%s'" % (room, self.action))
-        soco = klass.sonos['rooms'][room][0]
+        soco = self._resolve(kwargs)
         soco.mute = True
 
 
     def do_unmute(self, **kwargs):
-        klass = self.__class__
-        room = kwargs.get('room', klass.config['room'])
-        if room not in klass.sonos['rooms']:
-            raise InvalidParameterException("The value '%s' is invalid for parameter 'room' in action '%s'" % (room, self.action))
-        soco = klass.sonos['rooms'][room][0]
+        soco = self._resolve(kwargs)
         soco.mute = False
 
 
     def do_sync(self, **kwargs):
+        from soco.groups import ZoneGroup
+        from soco.exceptions import SoCoException
         klass = self.__class__
+        sync_key = (klass.soco.ip_address, repr(klass.config['rooms']))
+        if not kwargs.get('force', self.action == "sync") and sync_key == getattr(klass, '_last_sync_key', None):
+            if time.monotonic() - getattr(klass, '_last_sync_ts', 0) < 60:
+                logger.debug("[sonos] synced with SONOS less than 60 seconds ago, not syncing again")
+                return
         klass.sonos['zones'] = dict()
         klass.sonos['rooms'] = dict()
+        klass.sonos['topology'] = dict()
         try:
             for player in klass.soco.visible_zones:
                 try:
@@ -243,16 +263,175 @@ class Sonos(NeuronModule):
         except (BaseException, ConnectTimeout, TimeoutError, SoCoException) as e:
             Utils.print_warning("[sonos] error while merging (user-defined) rooms from settings: %s" % (str(e)))
         finally:
-            SettingEditor.set_variables({'sonos_rooms': {k.lower(): k for k, v in klass.sonos['rooms'].items()}})
+            klass.sonos['coordinators'] = {name: members[0] for name, members in klass.sonos['rooms'].items() if len(members) > 0}
+            fingerprint = tuple(sorted(klass.sonos['rooms'].keys()))
+            if fingerprint != getattr(klass, '_rooms_fp', None):
+                klass._rooms_fp = fingerprint
+                SettingEditor.set_variables({'sonos_rooms': {k.lower(): k for k, v in klass.sonos['rooms'].items()}})
+
+        if klass.sonos.get('favorites_dirty', True) or self.action == "sync":
+            klass._refresh_favorites(klass.soco, force=(self.action == "sync"))
+        if len(klass.sonos['zones']) > 0:
+            klass._last_sync_key = sync_key
+            klass._last_sync_ts = time.monotonic()
+        else:
+            klass._last_sync_ts = 0
+        Utils.print_success("[sonos] syncing with SONOS successful")
 
-        klass.sonos['favorites'] = dict()
+
+    @staticmethod
+    def _load_cached_soco(room):
+        from soco import SoCo
+        from soco.exceptions import SoCoException
         try:
-            for favorite in MusicLibrary(klass.soco).get_sonos_favorites():
-                klass.sonos['favorites'][favorite.title] = favorite
-        except (ConnectTimeout, TimeoutError, SoCoException) as e:
-            Utils.print_warning("[sonos] error while retrieving favorites from sonos: %s" % (str(e)))
-        finally:
-            logger.debug("[sonos] adding favorites by title as kalliope global variables (sonos_favorites[title]): %s" % klass.sonos['favorites'].keys())
-            SettingEditor.set_variables({'sonos_favorites': {k.lower(): k for k, v in klass.sonos['favorites'].items()}})
-        Utils.print_success("[sonos] syncing with SONOS successful")
+            with open(_CACHE, 'r') as f:
+                ipv4 = json.load(f).get(room, None)
+        except (OSError, ValueError, AttributeError):
+            return None
+        if ipv4 is None:
+            return None
+        logger.debug("[sonos] instantiating SoCo using cached IP address '%s' for room '%s'" % (ipv4, room))
+        try:
+            soco = SoCo(ipv4)
+            if soco.is_visible and soco.player_name == room:
+                return soco
+        except (RequestException, TimeoutError, SoCoException) as e:
+            logger.debug("[sonos] cached IP address '%s' for room '%s' unusable (%s)" % (ipv4, room, e.__class__.__name__))
+        return None
+
 
+    @staticmethod
+    def _store_cached_soco(room, soco):
+        cache = dict()
+        try:
+            with open(_CACHE, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if not isinstance(cache, dict):
+            cache = dict()
+        cache[room] = soco.ip_address
+        try:
+            os.makedirs(os.path.dirname(_CACHE), exist_ok=True)
+            with open(_CACHE, 'w') as f:
+                json.dump(cache, f)
+        except OSError as e:
+            logger.debug("[sonos] failed to write discovery cache '%s': %s" % (_CACHE, str(e)))
+
+
+    @staticmethod
+    def _match_favorite(item, titles):
+        if Sonos._RAPIDFUZZ is None:
+            try:
+                from rapidfuzz import process, fuzz
+                Sonos._RAPIDFUZZ = (process, fuzz)
+            except ImportError:
+                Sonos._RAPIDFUZZ = False
+        if Sonos._RAPIDFUZZ:
+            process, fuzz = Sonos._RAPIDFUZZ
+            return process.extractOne(item, titles, scorer=fuzz.WRatio, processor=None)[2]
+        from difflib import SequenceMatcher
+        best_ratio, best_index = -1.0, 0
+        matcher = SequenceMatcher(None, item, '')
+        for index, title in enumerate(titles):
+            matcher.set_seq2(title)
+            if matcher.real_quick_ratio() <= best_ratio:
+                continue
+            if matcher.quick_ratio() <= best_ratio:
+                continue
+            ratio = matcher.ratio()
+            if ratio > best_ratio:
+                best_ratio, best_index = ratio, index
+                if ratio == 1.0:
+                    break
+        return best_index
+
+
+    @staticmethod
+    def _is_grouped(soco, topology):
+        from soco.exceptions import SoCoException
+        try:
+            group = soco.group
+            if group is None or group.coordinator != soco:
+                return False
+            return set(member.ip_address for member in group.members if member.is_visible) == set(topology)
+        except (ConnectTimeout, TimeoutError, SoCoException) as e:
+            logger.debug("[sonos] failed to verify grouping of SoCo(%s) (%s)" % (soco.ip_address, e.__class__.__name__))
+        return False
+
+
+    @classmethod
+    def _refresh_favorites(klass, soco, force=False):
+        from soco.music_library import MusicLibrary
+        from soco.exceptions import SoCoException
+        update_id = klass.sonos.get('favorites_update_id', None)
+        watching = klass.subscription is not None and klass.subscription.is_subscribed
+        if not force and watching and update_id is not None and update_id == getattr(klass, '_favorites_update_id', None):
+            logger.debug("[sonos] favorites unchanged in SONOS (FavoritesUpdateID='%s'), not retrieving them again" % (update_id))
+            klass.sonos['favorites_dirty'] = False
+            return
+        favorites = dict()
+        try:
+            for favorite in MusicLibrary(soco).get_sonos_favorites():
+                favorites[favorite.title] = favorite
+        except (RequestException, TimeoutError, SoCoException) as e:
+            Utils.print_warning("[sonos] error while retrieving favorites from sonos (keeping previous favorites): %s" % (str(e)))
+            if 'favorites' not in klass.sonos:
+                klass.sonos['favorites'] = (tuple(), tuple(), tuple())
+            return
+        titles = tuple(favorites.keys())
+        # (titles, lower-cased titles, favorites) is published as one immutable snapshot in a single assignment
+        klass.sonos['favorites'] = (titles, tuple(title.lower() for title in titles), tuple(favorites.values()))
+        klass.sonos['favorites_dirty'] = False
+        klass._favorites_update_id = update_id
+        fingerprint = tuple(sorted(titles))
+        if fingerprint != getattr(klass, '_fav_fp', None):
+            klass._fav_fp = fingerprint
+            logger.debug("[sonos] adding favorites by title as kalliope global variables (sonos_favorites[title]): %s" % (titles, ))
+            SettingEditor.set_variables({'sonos_favorites': {k.lower(): k for k in titles}})
+
+
+    @classmethod
+    def _subscribe_favorites(klass):
+        if klass.subscription is not None:
+            try:
+                klass.subscription.unsubscribe()
+            except Exception as e:
+                logger.debug("[sonos] failed to unsubscribe from previous ContentDirectory events: %s" % (str(e)))
+            klass.subscription = None
+        try:
+            klass.subscription = klass.soco.contentDirectory.subscribe(auto_renew=True)
+        except Exception as e:
+            Utils.print_warning("[sonos] failed to subscribe to ContentDirectory events, favorites only refresh on action='sync': %s" % (str(e)))
+            return
+        klass.sonos['favorites_update_id'] = None
+        thread = threading.Thread(target=klass._watch_favorites, args=(klass.subscription,), daemon=True)
+        thread.start()
+
+
+    @classmethod
+    def _watch_favorites(klass, subscription):
+        while subscription.is_subscribed:
+            try:
+                event = subscription.events.get(timeout=1.0)
+            except Empty:
+                continue
+            try:
+                update_id = event.variables.get('favorites_update_id', None)
+                if update_id is None or update_id == klass.sonos.get('favorites_update_id', None):
+                    continue
+                if klass.sonos.get('favorites_update_id', None) is None and klass.sonos.get('favorites_dirty', True) is False:
+                    # initial event after subscribing, favorites were just retrieved by do_sync
+                    klass.sonos['favorites_update_id'] = update_id
+                    klass._favorites_update_id = update_id
+                    continue
+                logger.debug("[sonos] favorites changed in SONOS (FavoritesUpdateID='%s'), refreshing favorites" % (update_id))
+                klass.sonos['favorites_update_id'] = update_id
+                klass.sonos['favorites_dirty'] = True
+                klass._last_sync_ts = 0
+                klass._refresh_favorites(event.service.soco, force=True)
+            except Exception as e:
+                Utils.print_warning("[sonos] error while handling ContentDirectory event: %s" % (str(e)))
+        if klass.subscription is subscription:
+            Utils.print_warning("[sonos] subscription to ContentDirectory events ended, favorites only refresh on next sync")
+            klass.sonos['favorites_dirty'] = True